@@ -6,6 +6,11 @@ from dolfin import *
 
 from postprocessing_common import read_command_line, epsilon
 
+# Optimize the generated code of the element kernels assembled for every velocity snapshot
+parameters["form_compiler"]["optimize"] = True
+parameters["form_compiler"]["cpp_optimize"] = True
+parameters["form_compiler"]["cpp_optimize_flags"] = "-O3"
+
 
 def compute_flow_and_simulation_metrics(folder, nu, dt, velocity_degree):
     """
@@ -57,18 +62,13 @@ def compute_flow_and_simulation_metrics(folder, nu, dt, velocity_degree):
     v = TestFunction(DG)
     u = Function(V)
     u_mean = Function(V)
-    u_prime = Function(V)
 
     # Plus-values
     l_plus_avg = Function(DG)
-    l_plus = Function(DG)
     t_plus_avg = Function(DG)
-    t_plus = Function(DG)
 
     # Kolmogorov scales
-    length_scale = Function(DG)
     length_scale_avg = Function(DG)
-    time_scale = Function(DG)
     time_scale_avg = Function(DG)
     velocity_scale = Function(DG)
     velocity_scale_avg = Function(DG)
@@ -91,35 +91,54 @@ def compute_flow_and_simulation_metrics(folder, nu, dt, velocity_degree):
     u0 = Function(Vv)
     u1 = Function(Vv)
     u2 = Function(Vv)
-    u0_prime = Function(Vv)
-    u1_prime = Function(Vv)
-    u2_prime = Function(Vv)
+
+    # Map between the vector and component dofs, computed once instead of for every assign
+    dim = mesh.geometry().dim()
+    component_assigner = FunctionAssigner([Vv] * dim, V)
 
     # CFL
-    CFL = Function(DG)
     CFL_avg = Function(DG)
 
-    # Create XDMF files for saving metrics
-    fullname = file_path_u.replace("u.h5", "%s.xdmf")
-    fullname = fullname.replace("Solutions", "flow_metrics")
-    var_name = ["u_mean", "l_plus", "t_plus", "CFL", "strain", "length_scale", "time_scale", "velocity_scale", "u_mag",
-                "characteristic_edge_length", "dissipation", "kinetic_energy", "turbulent_kinetic_energy",
-                "turbulent_dissipation", "u_prime"]
-
-    metrics = {}
-    for vn in var_name:
-        if MPI.rank(MPI.comm_world) == 0:
-            print(fullname % vn)
-        metrics[vn] = XDMFFile(MPI.comm_world, fullname % vn)
-        metrics[vn].parameters["rewrite_function_mesh"] = False
-        metrics[vn].parameters["flush_output"] = True
+    # Projecting the velocity magnitude onto DG0 is local to each cell, so factorize the local problems once
+    u_mag = Function(DG)
+    u_mag_solver = LocalSolver(inner(TrialFunction(DG), v) * dx, inner(sqrt(inner(u, u)), v) * dx)
+    u_mag_solver.factorize()
+
+    # Compile forms once, and reassemble them as u is updated. The strain and dissipation share the strain-rate tensor
+    # of u, and are assembled together on a two component DG0 space. The turbulent dissipation is formed from u - u_mean
+    W = VectorFunctionSpace(mesh, 'DG', 0, dim=2)
+    strain_and_dissipation = Function(W)
+    strain_and_dissipation_form = rate_of_strain_and_dissipation(u, TestFunction(W), mesh, h, nu,
+                                                                 velocity_degree)
+    strain_and_dissipation_assigner = FunctionAssigner([DG, DG], W)
+    turbulent_dissipation_form = rate_of_dissipation(u - u_mean, v, mesh, h, nu, velocity_degree)
+
+    # Sum the per-snapshot metrics in local single precision arrays, and store the averages after the loop. The
+    # metrics themselves are computed in double precision
+    edge_length = characteristic_edge_length.vector().get_local()
+    CFL_sum = np.zeros_like(edge_length, dtype=np.float32)
+    l_plus_sum = np.zeros_like(edge_length, dtype=np.float32)
+    t_plus_sum = np.zeros_like(edge_length, dtype=np.float32)
+    length_scale_sum = np.zeros_like(edge_length, dtype=np.float32)
+    time_scale_sum = np.zeros_like(edge_length, dtype=np.float32)
+    velocity_scale_sum = np.zeros_like(edge_length, dtype=np.float32)
+    buffer = np.empty_like(edge_length)
+    velocity_scale_local = np.empty_like(edge_length)
+    kinetic_energy_sum = np.zeros(kinetic_energy.vector().local_size(), dtype=np.float32)
+    turbulent_kinetic_energy_sum = np.zeros_like(kinetic_energy_sum)
 
     # Get u mean
     u_mean_file_path = file_path_u.replace("u.h5", "u_mean.h5")
-    tmp_file = HDF5File(MPI.comm_world, u_mean_file_path, "r")
-    tmp_file.read(u, "u_mean/vector_0")
-    tmp_file.close()
-    assign(u_mean, u)
+    with HDF5File(MPI.comm_world, u_mean_file_path, "r") as u_mean_file:
+        u_mean_file.read(u_mean, "u_mean/vector_0")
+
+    # Components of the mean velocity, subtracted from the velocity components for the turbulent kinetic energy
+    component_assigner.assign([u0, u1, u2][:dim], u_mean)
+    u_mean_components = [u0.vector().get_local(), u1.vector().get_local(), u2.vector().get_local()]
+
+    # Loop invariant factors of the CFL number and l+
+    dt_over_edge_length = dt / edge_length
+    edge_length_over_sqrt_nu = edge_length / np.sqrt(nu)
 
     counter = 0
     for data in dataset_names:
@@ -134,101 +153,69 @@ def compute_flow_and_simulation_metrics(folder, nu, dt, velocity_degree):
 
         # Compute CFL
         t0 = Timer("CFL")
-        u_mag = project(sqrt(inner(u, u)), DG)
-        CFL.vector().set_local(u_mag.vector().get_local() / characteristic_edge_length.vector().get_local() * dt)
-        CFL.vector().apply("insert")
-        CFL_avg.vector().axpy(1, CFL.vector())
+        u_mag_solver.solve_local_rhs(u_mag)
+        np.multiply(u_mag.vector().get_local(), dt_over_edge_length, out=buffer)
+        CFL_sum += buffer
         t0.stop()
 
-        # Compute rate-of-strain
-        t0 = Timer("rate of strain")
-        rate_of_strain(strain, u, v, mesh, h)
+        # Compute rate-of-strain and rate of dissipation
+        t0 = Timer("rate of strain and dissipation")
+        assemble(strain_and_dissipation_form, tensor=strain_and_dissipation.vector())
+        strain_and_dissipation_assigner.assign([strain, dissipation], strain_and_dissipation)
         strain_avg.vector().axpy(1, strain.vector())
-        t0.stop()
-
-        # Compute l+
-        t0 = Timer("l plus")
-        u_star = np.sqrt(strain.vector().get_local() * nu)
-        l_plus.vector().set_local(u_star * characteristic_edge_length.vector().get_local() / nu)
-        l_plus.vector().apply("insert")
-        l_plus_avg.vector().axpy(1, l_plus.vector())
-        t0.stop()
-
-        # Compute t+
-        t0 = Timer("t plus")
-        t_plus.vector().set_local(u_star ** 2 * dt / nu)
-        t_plus.vector().apply("insert")
-        t_plus_avg.vector().axpy(1, t_plus.vector())
-        t0.stop()
-
-        # Compute Kolmogorov
-        t0 = Timer("dissipation")
-        rate_of_dissipation(dissipation, u, v, mesh, h, nu)
         dissipation_avg.vector().axpy(1, dissipation.vector())
         t0.stop()
 
-        # Compute u_prime
-        t0 = Timer("u prime")
-        u_prime.vector().set_local(u.vector().get_local() - u_mean.vector().get_local())
-        u_prime.vector().apply("insert")
+        # Compute l+ and t+
+        t0 = Timer("plus values")
+        # u_star * edge_length / nu reduces to sqrt(strain) * edge_length / sqrt(nu)
+        strain_local = strain.vector().get_local()
+        np.sqrt(strain_local, out=buffer)
+        np.multiply(buffer, edge_length_over_sqrt_nu, out=buffer)
+        l_plus_sum += buffer
+
+        # u_star ** 2 * dt / nu reduces to strain * dt
+        np.multiply(strain_local, dt, out=buffer)
+        t_plus_sum += buffer
         t0.stop()
 
         # Compute Turbulent dissipation
         t0 = Timer("turbulent dissipation")
-        rate_of_dissipation(turbulent_dissipation, u_prime, v, mesh, h, nu)
+        assemble(turbulent_dissipation_form, tensor=turbulent_dissipation.vector())
         turbulent_dissipation_avg.vector().axpy(1, turbulent_dissipation.vector())
         eps = turbulent_dissipation.vector().get_local()
         t0.stop()
 
-        # Compute length scale
-        t0 = Timer("length scale")
-        length_scale.vector().set_local((nu ** 3 / eps) ** (1. / 4))
-        length_scale.vector().apply("insert")
-        length_scale_avg.vector().axpy(1, length_scale.vector())
-        t0.stop()
-
-        # Compute time scale
-        t0 = Timer("time scale")
-        time_scale.vector().set_local((nu / eps) ** 0.5)
-        time_scale.vector().apply("insert")
-        time_scale_avg.vector().axpy(1, time_scale.vector())
-        t0.stop()
-
-        # Compute velocity scale
-        t0 = Timer("velocity scale")
-        velocity_scale.vector().set_local((eps * nu) ** (1. / 4))
-        velocity_scale.vector().apply("insert")
-        velocity_scale_avg.vector().axpy(1, velocity_scale.vector())
+        # Compute length, time and velocity scale
+        t0 = Timer("Kolmogorov scales")
+        np.multiply(eps, nu, out=velocity_scale_local)
+        np.power(velocity_scale_local, 1. / 4, out=velocity_scale_local)
+        velocity_scale_sum += velocity_scale_local
+
+        # (nu ** 3 / eps) ** (1 / 4) equals nu / velocity scale, and (nu / eps) ** 0.5 equals nu / velocity scale ** 2
+        np.divide(nu, velocity_scale_local, out=buffer)
+        length_scale_sum += buffer
+        np.divide(buffer, velocity_scale_local, out=buffer)
+        time_scale_sum += buffer
         t0.stop()
 
         # Compute both kinetic energy and turbulent kinetic energy
 
         t0 = Timer("kinetic energy")
-        assign(u0, u.sub(0))
-        assign(u1, u.sub(1))
-
-        if mesh.geometry().dim() == 3:
-            assign(u2, u.sub(2))
+        component_assigner.assign([u0, u1, u2][:dim], u)
+        u_components = [u0.vector().get_local(), u1.vector().get_local(), u2.vector().get_local()]
 
-        kinetic_energy.vector().set_local(
-            0.5 * (u0.vector().get_local() ** 2 + u1.vector().get_local() ** 2 + u2.vector().get_local() ** 2))
-        kinetic_energy.vector().apply("insert")
-        kinetic_energy_avg.vector().axpy(1, kinetic_energy.vector())
+        kinetic_energy_local = 0.5 * (u_components[0] ** 2 + u_components[1] ** 2 + u_components[2] ** 2)
+        kinetic_energy_sum += kinetic_energy_local
         t0.stop()
 
         t0 = Timer("turbulent kinetic energy")
-        assign(u0_prime, u_prime.sub(0))
-        assign(u1_prime, u_prime.sub(1))
-
-        if mesh.geometry().dim() == 3:
-            assign(u2_prime, u_prime.sub(2))
-
-        turbulent_kinetic_energy.vector().set_local(
-            0.5 * (u0_prime.vector().get_local() ** 2
-                   + u1_prime.vector().get_local() ** 2
-                   + u2_prime.vector().get_local() ** 2))
-        turbulent_kinetic_energy.vector().apply("insert")
-        turbulent_kinetic_energy_avg.vector().axpy(1, turbulent_kinetic_energy.vector())
+        u_prime_components = [u_i - u_mean_i for u_i, u_mean_i in zip(u_components, u_mean_components)]
+
+        turbulent_kinetic_energy_local = 0.5 * (u_prime_components[0] ** 2
+                                                + u_prime_components[1] ** 2
+                                                + u_prime_components[2] ** 2)
+        turbulent_kinetic_energy_sum += turbulent_kinetic_energy_local
         t0.stop()
 
         if counter % 10 == 0:
@@ -236,31 +223,40 @@ def compute_flow_and_simulation_metrics(folder, nu, dt, velocity_degree):
 
     # Get avg
     N = len(dataset_names)
-    l_plus_avg.vector()[:] = l_plus_avg.vector()[:] / N
-    t_plus_avg.vector()[:] = t_plus_avg.vector()[:] / N
-    length_scale_avg.vector()[:] = length_scale_avg.vector()[:] / N
-    time_scale_avg.vector()[:] = time_scale_avg.vector()[:] / N
-    velocity_scale_avg.vector()[:] = velocity_scale_avg.vector()[:] / N
-    CFL_avg.vector()[:] = CFL_avg.vector()[:] / N
+    for metric_avg, metric_sum in [(CFL_avg, CFL_sum), (l_plus_avg, l_plus_sum), (t_plus_avg, t_plus_sum),
+                                   (length_scale_avg, length_scale_sum), (time_scale_avg, time_scale_sum),
+                                   (velocity_scale_avg, velocity_scale_sum), (kinetic_energy_avg, kinetic_energy_sum),
+                                   (turbulent_kinetic_energy_avg, turbulent_kinetic_energy_sum)]:
+        metric_avg.vector().set_local(metric_sum.astype(np.float64) / N)
+        metric_avg.vector().apply("insert")
+
+    # Velocity scale and energies of the last time step, printed below
+    for metric, metric_local in [(velocity_scale, velocity_scale_local), (kinetic_energy, kinetic_energy_local),
+                                 (turbulent_kinetic_energy, turbulent_kinetic_energy_local)]:
+        metric.vector().set_local(metric_local)
+        metric.vector().apply("insert")
+
     dissipation_avg.vector()[:] = dissipation_avg.vector()[:] / N
-    kinetic_energy_avg.vector()[:] = kinetic_energy_avg.vector()[:] / N
-    turbulent_kinetic_energy_avg.vector()[:] = turbulent_kinetic_energy_avg.vector()[:] / N
     turbulent_dissipation_avg.vector()[:] = turbulent_dissipation_avg.vector()[:] / N
 
-    # Store average data
-    metrics["CFL"].write_checkpoint(CFL_avg, "CFL")
-    metrics["l_plus"].write_checkpoint(l_plus_avg, "l_plus")
-    metrics["t_plus"].write_checkpoint(t_plus_avg, "t_plus")
-    metrics["length_scale"].write_checkpoint(length_scale_avg, "length_scale")
-    metrics["time_scale"].write_checkpoint(time_scale_avg, "time_scale")
-    metrics["velocity_scale"].write_checkpoint(velocity_scale_avg, "velocity_scale")
-    metrics["dissipation"].write_checkpoint(dissipation_avg, "dissipation")
-    metrics["kinetic_energy"].write_checkpoint(kinetic_energy_avg, "kinetic_energy")
-    metrics["turbulent_kinetic_energy"].write_checkpoint(turbulent_kinetic_energy_avg, "turbulent_kinetic_energy")
-    metrics["turbulent_dissipation"].write_checkpoint(turbulent_dissipation_avg, "turbulent_dissipation")
-    metrics["characteristic_edge_length"].write_checkpoint(characteristic_edge_length, "characteristic_edge_length")
-    metrics["strain"].write_checkpoint(strain_avg, "strain_avg")
-    metrics["u_mean"].write_checkpoint(u_mean, "u_mean")
+    # Store average data, opening one XDMF file for each of the stored metrics
+    fullname = file_path_u.replace("u.h5", "%s.xdmf")
+    fullname = fullname.replace("Solutions", "flow_metrics")
+    metrics = [("CFL", CFL_avg, "CFL"), ("l_plus", l_plus_avg, "l_plus"), ("t_plus", t_plus_avg, "t_plus"),
+               ("length_scale", length_scale_avg, "length_scale"), ("time_scale", time_scale_avg, "time_scale"),
+               ("velocity_scale", velocity_scale_avg, "velocity_scale"),
+               ("dissipation", dissipation_avg, "dissipation"),
+               ("kinetic_energy", kinetic_energy_avg, "kinetic_energy"),
+               ("turbulent_kinetic_energy", turbulent_kinetic_energy_avg, "turbulent_kinetic_energy"),
+               ("turbulent_dissipation", turbulent_dissipation_avg, "turbulent_dissipation"),
+               ("characteristic_edge_length", characteristic_edge_length, "characteristic_edge_length"),
+               ("strain", strain_avg, "strain_avg"), ("u_mean", u_mean, "u_mean")]
+
+    for var_name, metric, checkpoint_name in metrics:
+        if MPI.rank(MPI.comm_world) == 0:
+            print(fullname % var_name)
+        with XDMFFile(MPI.comm_world, fullname % var_name) as metric_file:
+            metric_file.write_checkpoint(metric, checkpoint_name)
 
     # Print info
     flow_metrics = [("dx", characteristic_edge_length), ("l+", l_plus_avg), ("t+", t_plus_avg),
@@ -269,17 +265,24 @@ def compute_flow_and_simulation_metrics(folder, nu, dt, velocity_degree):
                     ("Dissipation", dissipation), ("Turbulent dissipation", turbulent_dissipation),
                     ("Turbulent kinetic energy", turbulent_kinetic_energy), ("Kinetic energy", kinetic_energy)]
 
-    for metric_name, metric_value in flow_metrics:
-        sum_ = MPI.sum(MPI.comm_world, np.sum(metric_value.vector().get_local()))
-        num = MPI.sum(MPI.comm_world, metric_value.vector().get_local().shape[0])
-        mean = sum_ / num
-        max_ = MPI.max(MPI.comm_world, metric_value.vector().get_local().max())
-        min_ = MPI.min(MPI.comm_world, metric_value.vector().get_local().min())
+    # Gather the local sum, size, max and min of all metrics to rank 0 in one collective
+    local_stats = []
+    for _, metric_value in flow_metrics:
+        values = metric_value.vector().get_local()
+        local_stats.append([values.sum(), values.size, values.max(), values.min()])
+    stats = MPI.comm_world.gather(np.array(local_stats), root=0)
 
-        if MPI.rank(MPI.comm_world) == 0:
-            print(metric_name, "mean:", mean)
-            print(metric_name, "max:", max_)
-            print(metric_name, "min:", min_)
+    if MPI.rank(MPI.comm_world) == 0:
+        stats = np.array(stats)
+        sum_ = stats[:, :, 0].sum(axis=0)
+        num = stats[:, :, 1].sum(axis=0)
+        max_ = stats[:, :, 2].max(axis=0)
+        min_ = stats[:, :, 3].min(axis=0)
+
+        for i, (metric_name, _) in enumerate(flow_metrics):
+            print(metric_name, "mean:", sum_[i] / num[i])
+            print(metric_name, "max:", max_[i])
+            print(metric_name, "min:", min_[i])
 
 
 def get_dataset_names(data_file, num_files=3000000, step=1, start=1, print_info=True,
@@ -298,23 +301,30 @@ def get_dataset_names(data_file, num_files=3000000, step=1, start=1, print_info=
     Returns:
         names (list): List of data file names
     """
-    check = True
-
-    # Find start file
     t0 = time()
-    while check:
-        if data_file.has_dataset(vector_filename % start):
-            check = False
-            start -= step
-
-        start += step
-
-    # Get names
-    names = []
-    for i in range(num_files):
-        step = 1
-        index = start + i * step
-        if data_file.has_dataset(vector_filename % index):
+
+    # A time series written by HDF5File stores the number of datasets as an attribute of its group
+    group_attributes = data_file.attributes(vector_filename.rsplit("/", 1)[0])
+    if "count" in group_attributes.list_attributes():
+        stop = min(int(group_attributes["count"]), start + num_files * step)
+        names = [vector_filename % index for index in range(start, stop, step)]
+    else:
+        check = True
+
+        # Find start file
+        while check:
+            if data_file.has_dataset(vector_filename % start):
+                check = False
+                start -= step
+
+            start += step
+
+        # Get names, the datasets are stored contiguously so stop at the first missing one
+        names = []
+        for i in range(num_files):
+            index = start + i * step
+            if not data_file.has_dataset(vector_filename % index):
+                break
             names.append(vector_filename % index)
 
     t1 = time()
@@ -333,41 +343,53 @@ def get_dataset_names(data_file, num_files=3000000, step=1, start=1, print_info=
     return names
 
 
-def rate_of_strain(strain, u, v, mesh, h):
+def rate_of_strain_and_dissipation(u, w, mesh, h, nu, velocity_degree):
     """
-    Computes rate of strain
+    Creates one form for the rate of strain and the rate of dissipation, sharing the strain-rate tensor
 
     Args:
-        strain (Function): Function to save rate of strain to
         u (Function): Function for velocity field
-        v (Function): Test function for velocity
-        mesh: Mesh to compute strain rate on
+        w (Function): Test function with two components, for the strain and dissipation
+        mesh: Mesh to compute strain and dissipation rate on
         h (float): Cell diameter of mesh
+        nu (float): Viscosity
+        velocity_degree (int): Finite element degree of velocity
+
+    Returns:
+        strain_and_dissipation_form (Form): Compiled form for the rate of strain and dissipation
     """
     eps = epsilon(u)
-    f = sqrt(inner(eps, eps))
-    x = assemble(inner(f, v) / h * dx(mesh))
-    strain.vector().set_local(x.get_local())
-    strain.vector().apply("insert")
+    eps_inner = inner(eps, eps)
+    f_strain = sqrt(eps_inner)
+    f_dissipation = 2 * nu * eps_inner
+
+    # inner(eps, eps) is a polynomial of degree 2 * (velocity_degree - 1), use a matching quadrature instead of the
+    # estimate for the square root
+    degree = 2 * (velocity_degree - 1)
+
+    return Form((inner(f_strain, w[0]) + inner(f_dissipation, w[1])) / h * dx(mesh, degree=degree))
 
 
-def rate_of_dissipation(dissipation, u, v, mesh, h, nu):
+def rate_of_dissipation(u, v, mesh, h, nu, velocity_degree):
     """
-    Computes rate of dissipation
+    Creates the form for the rate of dissipation
 
     Args:
-        dissipation (Function): Function to save rate of dissipation to
-        u (Function): Function for velocity field
+        u (Function): Function or expression for velocity field
         v (Function): Test function for velocity
         mesh: Mesh to compute dissipation rate on
         h (float): Cell diameter of mesh
         nu (float): Viscosity
+        velocity_degree (int): Finite element degree of velocity
+
+    Returns:
+        dissipation_form (Form): Compiled form for the rate of dissipation
     """
     eps = epsilon(u)
     f = 2 * nu * inner(eps, eps)
-    x = assemble(inner(f, v) / h * dx(mesh))
-    dissipation.vector().set_local(x.get_local())
-    dissipation.vector().apply("insert")
+    degree = 2 * (velocity_degree - 1)
+
+    return Form(inner(f, v) / h * dx(mesh, degree=degree))
 
 
 if __name__ == '__main__':
@@ -38,20 +38,17 @@ def visualize_probes(case_path, probe_saving_frequency, show_figure=True, save_f
                                     probe_saving_frequency)
 
         # Load velocity component and pressure probes
-        u = path.join(case_path, "u_x_{}.probes".format(tstep))
-        v = path.join(case_path, "u_y_{}.probes".format(tstep))
-        w = path.join(case_path, "u_z_{}.probes".format(tstep))
-        p = path.join(case_path, "p_{}.probes".format(tstep))
-
-        try:
-            p_probe = np.load(p, allow_pickle=True)
-            u_probe = np.load(u, allow_pickle=True)
-            v_probe = np.load(v, allow_pickle=True)
-            w_probe = np.load(w, allow_pickle=True)
-        except:
+        probes_path = path.join(case_path, "probes_{}.npz".format(tstep))
+        if not path.isfile(probes_path):
             print("-- Finished reading in probes")
             break
 
+        with np.load(probes_path) as probes:
+            p_probe = probes["p"]
+            u_probe = probes["u_x"]
+            v_probe = probes["u_y"]
+            w_probe = probes["u_z"]
+
         # Create velocity magnitude
         U = np.sqrt(u_probe ** 2 + v_probe ** 2 + w_probe ** 2)
         if counter == 0:
@@ -2,13 +2,16 @@
 from __future__ import print_function
 
 import argparse
-from os import remove
+import logging
+import sys
+from os import remove, scandir
+
+from scipy.spatial import cKDTree
+from vtk.util.numpy_support import vtk_to_numpy
 
 import ToolRepairSTL
 # Local imports
 from common import *
-from simulate import run_simulation
-from visualize import visualize
 
 
 def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothing_factor, meshing_method,
@@ -43,25 +46,29 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
     abs_path = path.abspath(path.dirname(__file__))
     case_name = filename_model.rsplit(path.sep, 1)[-1].rsplit('.')[0]
     dir_path = filename_model.rsplit(path.sep, 1)[0]
+    case_path = path.join(dir_path, case_name)
 
     # Naming conventions
-    file_name_centerlines = path.join(dir_path, case_name + "_centerlines.vtp")
-    file_name_refine_region_centerlines = path.join(dir_path, case_name + "_refine_region_centerline.vtp")
-    file_name_region_centerlines = path.join(dir_path, case_name + "_sac_centerline_{}.vtp")
-    file_name_distance_to_sphere_diam = path.join(dir_path, case_name + "_distance_to_sphere_diam.vtp")
-    file_name_distance_to_sphere_const = path.join(dir_path, case_name + "_distance_to_sphere_const.vtp")
-    file_name_distance_to_sphere_curv = path.join(dir_path, case_name + "_distance_to_sphere_curv.vtp")
-    file_name_probe_points = path.join(dir_path, case_name + "_probe_point")
-    file_name_voronoi = path.join(dir_path, case_name + "_voronoi.vtp")
-    file_name_voronoi_smooth = path.join(dir_path, case_name + "_voronoi_smooth.vtp")
-    file_name_surface_smooth = path.join(dir_path, case_name + "_smooth.vtp")
-    file_name_model_flow_ext = path.join(dir_path, case_name + "_flowext.vtp")
-    file_name_clipped_model = path.join(dir_path, case_name + "_clippedmodel.vtp")
-    file_name_flow_centerlines = path.join(dir_path, case_name + "_flow_cl.vtp")
-    file_name_surface_name = path.join(dir_path, case_name + "_remeshed_surface.vtp")
-    file_name_xml_mesh = path.join(dir_path, case_name + ".xml")
-    file_name_vtu_mesh = path.join(dir_path, case_name + ".vtu")
-    file_name_run_script = path.join(dir_path, case_name + ".sh")
+    file_name_centerlines = case_path + "_centerlines.vtp"
+    file_name_refine_region_centerlines = case_path + "_refine_region_centerline.vtp"
+    file_name_region_centerlines = case_path + "_sac_centerline_{}.vtp"
+    file_name_distance_to_sphere_diam = case_path + "_distance_to_sphere_diam.vtp"
+    file_name_distance_to_sphere_const = case_path + "_distance_to_sphere_const.vtp"
+    file_name_distance_to_sphere_curv = case_path + "_distance_to_sphere_curv.vtp"
+    file_name_probe_points = case_path + "_probe_point"
+    file_name_voronoi = case_path + "_voronoi.vtp"
+    file_name_voronoi_smooth = case_path + "_voronoi_smooth.vtp"
+    file_name_surface_smooth = case_path + "_smooth.vtp"
+    file_name_model_flow_ext = case_path + "_flowext.vtp"
+    file_name_clipped_model = case_path + "_clippedmodel.vtp"
+    file_name_flow_centerlines = case_path + "_flow_cl.vtp"
+    file_name_surface_name = case_path + "_remeshed_surface.vtp"
+    file_name_xml_mesh = case_path + ".xml"
+    file_name_vtu_mesh = case_path + ".vtu"
+    file_name_run_script = case_path + ".sh"
+
+    # List the case folder once, instead of checking for each cached file separately
+    existing_files = set(entry.name for entry in scandir(dir_path) if entry.is_file())
 
     print("\n--- Working on case:", case_name, "\n")
 
@@ -71,7 +78,7 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
 
     # Check if surface is closed and uncapps model if True
     if is_surface_capped(surface)[0] and smoothing_method != "voronoi":
-        if not path.isfile(file_name_clipped_model):
+        if path.basename(file_name_clipped_model) not in existing_files:
             print("--- Clipping the models inlets and outlets.\n")
             # TODO: Add input parameters as input to automatedPreProcessing
             # Value of gradients_limit should be generally low, to detect flat surfaces corresponding
@@ -82,7 +89,7 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
             write_polydata(surface, file_name_clipped_model)
         else:
             surface = read_polydata(file_name_clipped_model)
-    parameters = get_parameters(path.join(dir_path, case_name))
+    parameters = get_parameters(case_path)
 
     if "check_surface" not in parameters.keys():
         surface = vtk_clean_polydata(surface)
@@ -98,14 +105,14 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
                                 "Nan coordinates or some other shenanigans."))
         else:
             parameters["check_surface"] = True
-            write_parameters(parameters, path.join(dir_path, case_name))
+            write_parameters(parameters, case_path)
 
     # Create a capped version of the surface
     capped_surface = vmtk_cap_polydata(surface)
 
     # Get centerlines
     print("--- Get centerlines\n")
-    inlet, outlets = get_centers_for_meshing(surface, is_atrium, path.join(dir_path, case_name))
+    inlet, outlets = get_centers_for_meshing(surface, is_atrium, case_path)
     source = outlets if is_atrium else inlet
     target = inlet if is_atrium else outlets
 
@@ -117,7 +124,7 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
     misr_max = []
 
     if refine_region:
-        regions = get_regions_to_refine(capped_surface, region_points, path.join(dir_path, case_name))
+        regions = get_regions_to_refine(capped_surface, region_points, case_path)
         for i in range(len(regions) // 3):
             print("--- Region to refine ({}): {:.3f} {:.3f} {:.3f}"
                   .format(i + 1, regions[3 * i], regions[3 * i + 1], regions[3 * i + 2]))
@@ -125,55 +132,38 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
         centerlineAnu, _, _ = compute_centerlines(source, regions, file_name_refine_region_centerlines, capped_surface,
                                                   resampling=0.1)
 
-        # Extract the region centerline
-        refine_region_centerline = []
-        info = get_parameters(path.join(dir_path, case_name))
-        num_anu = info["number_of_regions"]
-
-        # Compute mean distance between points
-        for i in range(num_anu):
-            if not path.isfile(file_name_region_centerlines.format(i)):
-                line = extract_single_line(centerlineAnu, i)
-                locator = get_vtk_point_locator(centerlines)
-                for j in range(line.GetNumberOfPoints() - 1, 0, -1):
-                    point = line.GetPoints().GetPoint(j)
-                    ID = locator.FindClosestPoint(point)
-                    tmp_point = centerlines.GetPoints().GetPoint(ID)
-                    dist = np.sqrt(np.sum((np.asarray(point) - np.asarray(tmp_point)) ** 2))
-                    if dist <= tol:
-                        break
-
-                tmp = extract_single_line(line, 0, start_id=j)
-                write_polydata(tmp, file_name_region_centerlines.format(i))
-
-                # List of VtkPolyData sac(s) centerline
-                refine_region_centerline.append(tmp)
+        # Search tree for the closest point on the centerlines
+        num_anu = len(regions) // 3
+        centerline_tree = cKDTree(vtk_to_numpy(centerlines.GetPoints().GetData()))
 
-            else:
-                refine_region_centerline.append(read_polydata(file_name_region_centerlines.format(i)))
+        # Extract the region centerlines, giving a list of VtkPolyData sac(s) centerline
+        refine_region_centerline = [extract_region_centerline(centerlineAnu, i, centerline_tree, tol,
+                                                              file_name_region_centerlines.format(i))
+                                    for i in range(num_anu)]
 
         # Merge the sac centerline
         region_centerlines = vtk_merge_polydata(refine_region_centerline)
 
-        for region in refine_region_centerline:
-            region_factor = 0.9 if is_atrium else 0.5
-            region_center.append(region.GetPoints().GetPoint(int(region.GetNumberOfPoints() * region_factor)))
-            tmp_misr = get_point_data_array(radiusArrayName, region)
-            misr_max.append(tmp_misr.max())
+        # Get region center and maximum inscribed sphere radius, reading the radius array without copying
+        region_factor = 0.9 if is_atrium else 0.5
+        region_center = [region.GetPoint(int(region.GetNumberOfPoints() * region_factor))
+                         for region in refine_region_centerline]
+        misr_max = [vtk_to_numpy(region.GetPointData().GetArray(radiusArrayName)).max()
+                    for region in refine_region_centerline]
 
     # Smooth surface
     if smoothing_method == "voronoi":
         print("--- Smooth surface: Voronoi smoothing\n")
-        if not path.isfile(file_name_surface_smooth):
+        if path.basename(file_name_surface_smooth) not in existing_files:
             # Get Voronoi diagram
-            if not path.isfile(file_name_voronoi):
+            if path.basename(file_name_voronoi) not in existing_files:
                 voronoi = make_voronoi_diagram(surface, file_name_voronoi)
                 write_polydata(voronoi, file_name_voronoi)
             else:
                 voronoi = read_polydata(file_name_voronoi)
 
             # Get smooth Voronoi diagram
-            if not path.isfile(file_name_voronoi_smooth):
+            if path.basename(file_name_voronoi_smooth) not in existing_files:
                 if refine_region:
                     smooth_voronoi = smooth_voronoi_diagram(voronoi, centerlines, smoothing_factor, region_centerlines)
                 else:
@@ -191,7 +181,7 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
 
             # Check if there has been added new outlets
             num_outlets = centerlines.GetNumberOfLines()
-            num_outlets_after = compute_centers(surface_uncapped, is_atrium, test_capped=True)[1]
+            num_outlets_after = count_open_boundaries(surface_uncapped) - 1
 
             if num_outlets != num_outlets_after:
                 surface = vmtk_smooth_surface(surface, "laplace", iterations=200)
@@ -216,7 +206,7 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
 
     elif smoothing_method in ["laplace", "taubin"]:
         print("--- Smooth surface: {} smoothing\n".format(smoothing_method.capitalize()))
-        if not path.isfile(file_name_surface_smooth):
+        if path.basename(file_name_surface_smooth) not in existing_files:
             surface = vmtk_smooth_surface(surface, smoothing_method, iterations=400)
 
             # Save the smoothed surface
@@ -228,35 +218,48 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
     elif smoothing_method == "no_smooth" or None:
         print("--- No smoothing of surface\n")
 
-    # Add flow extensions
+    # Choose input for the mesh
+    distance_to_sphere_methods = {
+        "constant": (dist_sphere_constant, file_name_distance_to_sphere_const, edge_length),
+        "curvature": (dist_sphere_curvature, file_name_distance_to_sphere_curv, coarsening_factor),
+        "diameter": (dist_sphere_diam, file_name_distance_to_sphere_diam, coarsening_factor)
+    }
+    dist_sphere, file_name_distance_to_sphere, factor = distance_to_sphere_methods[meshing_method]
+    distance_to_sphere_cached = path.basename(file_name_distance_to_sphere) in existing_files
+
+    # Add flow extensions, and get new centerlines with the flow extensions
+    surface_extended = surface
     if create_flow_extensions:
-        if not path.isfile(file_name_model_flow_ext):
+        flow_centerlines_cached = path.basename(file_name_flow_centerlines) in existing_files
+        if path.basename(file_name_model_flow_ext) not in existing_files:
             print("--- Adding flow extensions\n")
             # Add extension normal on boundary for atrium models
             extension = "centerlinedirection" if is_atrium else "boundarynormal"
-            surface_extended = add_flow_extension(surface, centerlines, include_outlet=False,
-                                                  extension_length=inlet_flow_extension_length,
-                                                  extension_mode=extension)
-            surface_extended = add_flow_extension(surface_extended, centerlines, include_outlet=True,
-                                                  extension_length=outlet_flow_extension_length)
+            if extension == "boundarynormal" and inlet_flow_extension_length == outlet_flow_extension_length:
+                # Same extensions at all boundaries, add them in a single pass
+                surface_extended = add_flow_extension(surface, centerlines, include_outlet=True,
+                                                      extension_length=inlet_flow_extension_length,
+                                                      include_all=True)
+            else:
+                surface_extended = add_flow_extension(surface, centerlines, include_outlet=False,
+                                                      extension_length=inlet_flow_extension_length,
+                                                      extension_mode=extension)
+                surface_extended = add_flow_extension(surface_extended, centerlines, include_outlet=True,
+                                                      extension_length=outlet_flow_extension_length)
 
             surface_extended = vmtk_smooth_surface(surface_extended, "laplace", iterations=200)
             write_polydata(surface_extended, file_name_model_flow_ext)
-        else:
+        elif viz or not (flow_centerlines_cached and distance_to_sphere_cached):
+            # The extended surface is only read if a later step uses it
             surface_extended = read_polydata(file_name_model_flow_ext)
-    else:
-        surface_extended = surface
 
-    # Capp surface with flow extensions
-    capped_surface = vmtk_cap_polydata(surface_extended)
-
-    # Get new centerlines with the flow extensions
-    if create_flow_extensions:
-        if not path.isfile(file_name_flow_centerlines):
+        if not flow_centerlines_cached:
             print("--- Compute the model centerlines with flow extension.\n")
+            # Capp surface with flow extensions
+            capped_surface = vmtk_cap_polydata(surface_extended)
+
             # Compute the centerlines.
-            inlet, outlets = get_centers_for_meshing(surface_extended, is_atrium, path.join(dir_path, case_name),
-                                                     use_flow_extensions=True)
+            inlet, outlets = get_centers_for_meshing(surface_extended, is_atrium, case_path, use_flow_extensions=True)
             # FIXME: There are several inlets and one outlet for atrium case
             source = outlets if is_atrium else inlet
             target = inlet if is_atrium else outlets
@@ -266,30 +269,15 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
         else:
             centerlines = read_polydata(file_name_flow_centerlines)
 
-    # Choose input for the mesh
     print("--- Computing distance to sphere\n")
-    if meshing_method == "constant":
-        if not path.isfile(file_name_distance_to_sphere_const):
-            distance_to_sphere = dist_sphere_constant(surface_extended, centerlines, region_center, misr_max,
-                                                      file_name_distance_to_sphere_const, edge_length)
-        else:
-            distance_to_sphere = read_polydata(file_name_distance_to_sphere_const)
-
-    elif meshing_method == "curvature":
-        if not path.isfile(file_name_distance_to_sphere_curv):
-            distance_to_sphere = dist_sphere_curvature(surface_extended, centerlines, region_center, misr_max,
-                                                       file_name_distance_to_sphere_curv, coarsening_factor)
-        else:
-            distance_to_sphere = read_polydata(file_name_distance_to_sphere_curv)
-    elif meshing_method == "diameter":
-        if not path.isfile(file_name_distance_to_sphere_diam):
-            distance_to_sphere = dist_sphere_diam(surface_extended, centerlines, region_center, misr_max,
-                                                  file_name_distance_to_sphere_diam, coarsening_factor)
-        else:
-            distance_to_sphere = read_polydata(file_name_distance_to_sphere_diam)
+    if not distance_to_sphere_cached:
+        distance_to_sphere = dist_sphere(surface_extended, centerlines, region_center, misr_max,
+                                         file_name_distance_to_sphere, factor)
+    else:
+        distance_to_sphere = read_polydata(file_name_distance_to_sphere)
 
     # Compute mesh
-    if not path.isfile(file_name_vtu_mesh):
+    if path.basename(file_name_vtu_mesh) not in existing_files:
         try:
             print("--- Computing mesh\n")
             mesh, remeshed_surface = generate_mesh(distance_to_sphere)
@@ -297,7 +285,9 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
                 "No points in surface mesh, try to remesh"
             assert mesh.GetNumberOfPoints() > 0, "No points in mesh, try to remesh"
 
-        except:
+        except (RuntimeError, AssertionError):
+            # Release the failed attempt before meshing the smoothed surface
+            mesh = remeshed_surface = None
             distance_to_sphere = mesh_alternative(distance_to_sphere)
             mesh, remeshed_surface = generate_mesh(distance_to_sphere)
             assert mesh.GetNumberOfPoints() > 0, "No points in mesh, after remeshing"
@@ -313,26 +303,31 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
     network, probe_points = setup_model_network(centerlines, file_name_probe_points, region_center, verbose_print)
 
     # BSL method for mean inlet flow rate.
-    parameters = get_parameters(path.join(dir_path, case_name))
+    parameters = get_parameters(case_path)
 
     print("--- Computing flow rates and flow split, and setting boundary IDs\n")
     mean_inflow_rate = compute_flow_rate(is_atrium, inlet, parameters)
 
-    find_boundaries(path.join(dir_path, case_name), mean_inflow_rate, network, mesh, verbose_print, is_atrium)
+    find_boundaries(case_path, mean_inflow_rate, network, mesh, verbose_print, is_atrium)
 
     # Display the flow split at the outlets, inlet flow rate, and probes.
     if viz:
+        from visualize import visualize
+
         print("--- Visualizing flow split at outlets, inlet flow rate, and probes in VTK render window. ")
         print("--- Press 'q' inside the render window to exit.")
         visualize(network.elements, probe_points, surface_extended, mean_inflow_rate)
 
     # Start simulation though ssh, without password
     if config_path is not None:
+        from simulate import run_simulation
 
         # Set up simulation script
-        if not path.exists(file_name_run_script):
-            run_script_sample = open(path.join(abs_path, "run_script.sh"), "r").read()
-            config = json.load(open(config_path))
+        if path.basename(file_name_run_script) not in existing_files:
+            with open(path.join(abs_path, "run_script.sh"), "r") as f:
+                run_script_sample = f.read()
+            with open(config_path) as f:
+                config = json.load(f)
             run_dict = dict(mesh_name=case_name,
                             num_nodes=1,
                             hours=120,
@@ -342,9 +337,8 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
             run_script = run_script_sample.format(**run_dict)
 
             # Write script
-            script_file = open(file_name_run_script, "w")
-            script_file.write(run_script)
-            script_file.close()
+            with open(file_name_run_script, "w") as script_file:
+                script_file.write(run_script)
 
         run_simulation(config_path, dir_path, case_name)
 
@@ -359,9 +353,12 @@ def run_pre_processing(filename_model, verbose_print, smoothing_method, smoothin
             remove(file)
 
 
-def read_command_line():
+def create_argument_parser():
     """
-    Read arguments from commandline and return all values in a dictionary.
+    Create parser for the commandline arguments.
+
+    Returns:
+        parser (ArgumentParser): Parser for the commandline arguments
     """
     parser = argparse.ArgumentParser(
         description="Automated pre-processing for vascular modeling.")
@@ -477,19 +474,35 @@ def read_command_line():
                         help='Path to configuration file for remote simulation. ' +
                              'See example/ssh_config.json for details')
 
-    args, _ = parser.parse_known_args()
+    return parser
+
+
+# Commandline parser, created once and reused for every call to read_command_line
+argument_parser = create_argument_parser()
+
+
+def read_command_line():
+    """
+    Read arguments from commandline and return all values in a dictionary.
+    """
+    args, _ = argument_parser.parse_known_args()
+
+    # Verbose output is logged at debug level, which is only formatted when verbose mode is on
+    logger = logging.getLogger("vampy.preprocessing")
+    logger.propagate = False
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
 
     if args.verbosity:
         print()
         print("--- VERBOSE MODE ACTIVATED ---")
-
-        def verbose_print(*args):
-            for arg in args:
-                print(arg, end=' ')
-                print()
+        logger.setLevel(logging.DEBUG)
     else:
-        verbose_print = lambda *a: None
+        logger.setLevel(logging.WARNING)
 
+    verbose_print = logger.debug
     verbose_print(args)
 
     return dict(filename_model=args.fileNameModel, verbose_print=verbose_print, smoothing_method=args.smoothingMethod,
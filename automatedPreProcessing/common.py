@@ -7,8 +7,11 @@ try:
     from vmtkpointselector import *
 except ImportError:
     pass
+import gzip
+import shutil
 import numpy as np
-from os import path
+from os import path, remove
+from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
 
 # Global array names
 radiusArrayName = 'MaximumInscribedSphereRadius'
@@ -110,6 +113,38 @@ def provide_region_points(surface, provided_points, dir_path=None):
     return points
 
 
+def extract_region_centerline(centerlines_region, region_id, centerline_tree, tol, file_path):
+    """
+    Extract the part of a region centerline which does not overlap the model centerlines,
+    or read it from file if it has already been computed.
+
+    Args:
+        centerlines_region (vtkPolyData): Centerlines from the inlet to the regions
+        region_id (int): Index of the region centerline
+        centerline_tree (cKDTree): Search tree over the points of the model centerlines
+        tol (float): Tolerance for a point to be considered on the model centerlines
+        file_path (str): Location of the region centerline file
+
+    Returns:
+        region_centerline (vtkPolyData): Centerline of the region
+    """
+    if path.isfile(file_path):
+        return read_polydata(file_path)
+
+    line = extract_single_line(centerlines_region, region_id)
+
+    # Find the last point along the region centerline within the tolerance of the centerlines
+    line_points = vtk_to_numpy(line.GetPoints().GetData())
+    dist, _ = centerline_tree.query(line_points[1:])
+    points_within_tol = np.nonzero(dist <= tol)[0]
+    start_id = int(points_within_tol[-1]) + 1 if points_within_tol.size > 0 else 1
+
+    region_centerline = extract_single_line(line, 0, start_id=start_id)
+    write_polydata(region_centerline, file_path)
+
+    return region_centerline
+
+
 def make_voronoi_diagram(surface, file_path):
     """
     Compute the voronoi diagram of surface model.
@@ -134,6 +169,28 @@ def make_voronoi_diagram(surface, file_path):
     return voronoi.VoronoiDiagram
 
 
+def count_open_boundaries(surface):
+    """
+    Count the number of openings in the surface, without computing their centers or areas.
+
+    Args:
+        surface (vtkPolyData): Input surface model
+
+    Returns:
+        num_boundaries (int): Number of connected boundary edge loops
+    """
+    boundary_edges = vtk_extract_feature_edges(surface)
+    if boundary_edges.GetNumberOfCells() == 0:
+        return 0
+
+    connectivity = vtk.vtkPolyDataConnectivityFilter()
+    connectivity.SetInputData(boundary_edges)
+    connectivity.SetExtractionModeToAllRegions()
+    connectivity.Update()
+
+    return connectivity.GetNumberOfExtractedRegions()
+
+
 def compute_centers_for_meshing(surface, is_atrium, case_path=None, test_capped=False):
     """
     Compute the center of all the openings in the surface. The inlet is chosen based on
@@ -170,11 +227,7 @@ def compute_centers_for_meshing(surface, is_atrium, case_path=None, test_capped=
         return region_array.max() >= 1, region_array.max()
 
     # Get points
-    points = []
-    get_point = outputs.GetPoints().GetPoint
-    for i in range(region_array.shape[0]):
-        points.append(get_point(i))
-    points = np.asarray(points)
+    points = vtk_to_numpy(outputs.GetPoints().GetData()).astype(np.float64)
 
     # Get area and center
     area = []
@@ -503,41 +556,24 @@ def compute_distance_to_sphere(surface, center_sphere, radius_sphere=0.0, distan
         surface (vtkPolyData): Modified surface model with distances
     """
     # Check if there allready exists a distance to spheres
-    N = surface.GetNumberOfPoints()
     number, names = get_number_of_arrays(surface)
-    add = False
-    if distanceToSpheresArrayName not in names:
-        add = True
-
-    # Get array
-    if add:
-        dist_array = get_vtk_array(distanceToSpheresArrayName, 1, N)
-        surface.GetPointData().AddArray(dist_array)
-    else:
-        dist_array = surface.GetPointData().GetArray("DistanceToSpheres")
-
-    # Compute distance
-    for i in range(N):
-        distanceToSphere = dist_array.GetComponent(i, 0)
-
-        # Get distance, but factor in size of sphere
-        newDist = get_distance(center_sphere, surface.GetPoints().GetPoint(i)) - radius_sphere
-
-        # Set offset and scale distance
-        newDist = distance_offset + newDist * distance_scale
+    add = distanceToSpheresArrayName not in names
 
-        # Capp to min distance
-        if newDist < min_distance:
-            newDist = min_distance
+    # Get distance, but factor in size of sphere
+    points = vtk_to_numpy(surface.GetPoints().GetData())
+    new_dist = np.linalg.norm(points - np.asarray(center_sphere), axis=1) - radius_sphere
 
-        # Capp to max distance
-        if newDist > max_distance:
-            newDist = max_distance
+    # Set offset and scale distance, and capp to min and max distance
+    new_dist = np.clip(distance_offset + new_dist * distance_scale, min_distance, max_distance)
 
-        # Keep smallest distance
-        newDist = min(newDist, distanceToSphere) if not add else newDist
+    # Keep smallest distance
+    if not add:
+        dist_array = surface.GetPointData().GetArray(distanceToSpheresArrayName)
+        new_dist = np.minimum(new_dist, vtk_to_numpy(dist_array))
 
-        dist_array.SetComponent(i, 0, newDist)
+    dist_array = numpy_to_vtk(new_dist, deep=True)
+    dist_array.SetName(distanceToSpheresArrayName)
+    surface.GetPointData().AddArray(dist_array)
 
     return surface
 
@@ -589,7 +625,7 @@ def find_boundaries(model_path, mean_inflow_rate, network, mesh, verbose_print,
         mean_inflow_rate (float): Flow rate
         network (Network): Flow splitting network based on network boundary condition
         mesh (vtkUnstructuredGrid): Volumetric mesh
-        verbose_print (bool): Prints additional info if True
+        verbose_print (method): Prints additional info in verbose mode
         is_atrium (bool): Determines if model represents atrium or artery
     """
     # Extract the surface mesh of the wall
@@ -635,8 +671,8 @@ def find_boundaries(model_path, mean_inflow_rate, network, mesh, verbose_print,
             ids.append([cellEntityId, beta])
             verbose_print(beta)
             verbose_print(network.elements[closest].GetOutPointsx1()[0])
-        verbose_print('CellEntityId: %d\n' % cellEntityId)
-        verbose_print('meshPoint: %f, %f, %f\n' % (meshPoint[0], meshPoint[1], meshPoint[2]))
+        verbose_print('CellEntityId: %d', cellEntityId)
+        verbose_print('meshPoint: %f, %f, %f', meshPoint[0], meshPoint[1], meshPoint[2])
         verbose_print(ids)
 
     # Store information for the solver.
@@ -671,7 +707,7 @@ def setup_model_network(centerlines, file_name_probe_points, region_center, verb
         centerlines (vtkPolyData): Centerlines representing meshed model
         file_name_probe_points (str): Save path of probe points
         region_center (list): List of points representing region of refinement
-        verbose_print (bool): Prints additional info if True
+        verbose_print (method): Prints additional info in verbose mode
 
     Returns:
         network (Network): Network model
@@ -750,13 +786,20 @@ def write_mesh(compress_mesh, file_name_surface_name, file_name_vtu_mesh, file_n
     meshWriter.CellEntityIdsArrayName = "CellEntityIds"
     meshWriter.Mesh = mesh
     meshWriter.Mode = "ascii"
-    meshWriter.Compressed = compress_mesh
+    meshWriter.Compressed = 0
     meshWriter.OutputFileName = file_name_xml_mesh
     meshWriter.Execute()
 
+    # Compress in chunks with a fast compression level, instead of reading the whole XML into memory
+    if compress_mesh:
+        with open(file_name_xml_mesh, "rb") as f_in:
+            with gzip.open(file_name_xml_mesh + ".gz", "wb", compresslevel=1) as f_out:
+                shutil.copyfileobj(f_in, f_out, 2 ** 20)
+        remove(file_name_xml_mesh)
+
 
 def add_flow_extension(surface, centerlines, include_outlet, extension_length=2.0,
-                       extension_mode="boundarynormal"):
+                       extension_mode="boundarynormal", include_all=False):
     """
     Adds flow extensions to either all inlets or all outlets with specified extension length.
 
@@ -766,6 +809,7 @@ def add_flow_extension(surface, centerlines, include_outlet, extension_length=2.
         include_outlet (bool): Determines if outlet should be included or not
         extension_length (float): Determines length of flow extensions. Factor is multiplied with MISR at relevant boundary
         extension_mode (str): Determines how extensions are place, either normal to boundary or following centerline direction
+        include_all (bool): Extend all boundaries in one pass, ignoring include_outlet
 
     Returns:
         surface_extended (vtkPolyData): Extended surface model
@@ -776,19 +820,23 @@ def add_flow_extension(surface, centerlines, include_outlet, extension_length=2.
     boundaryExtractor.Update()
     boundaries = boundaryExtractor.GetOutput()
 
-    # Find outlet
-    lengths = []
-    for i in range(boundaries.GetNumberOfCells()):
-        lengths.append(get_curvilinear_coordinate(boundaries.GetCell(i))[-1])
-    outlet_id = lengths.index(max(lengths))
-
-    # Exclude outlet or inlets
     boundaryIds = vtk.vtkIdList()
-    for i in range(centerlines.GetNumberOfLines() + 1):
-        if include_outlet and i == outlet_id:
-            boundaryIds.InsertNextId(i)
-        if not include_outlet and i != outlet_id:
+    if include_all:
+        for i in range(centerlines.GetNumberOfLines() + 1):
             boundaryIds.InsertNextId(i)
+    else:
+        # Find outlet
+        lengths = []
+        for i in range(boundaries.GetNumberOfCells()):
+            lengths.append(get_curvilinear_coordinate(boundaries.GetCell(i))[-1])
+        outlet_id = lengths.index(max(lengths))
+
+        # Exclude outlet or inlets
+        for i in range(centerlines.GetNumberOfLines() + 1):
+            if include_outlet and i == outlet_id:
+                boundaryIds.InsertNextId(i)
+            if not include_outlet and i != outlet_id:
+                boundaryIds.InsertNextId(i)
 
     flowExtensionsFilter = vtkvmtk.vtkvmtkPolyDataFlowExtensionsFilter()
     flowExtensionsFilter.SetInputData(surface)
@@ -1,26 +1,52 @@
 from __future__ import print_function
 
-import errno
 import json
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import paramiko
 
 
-def exists(sftp, path):
+@contextmanager
+def ssh_session(config, client=None):
     """
-    os.path.exists for paramiko's SCP object
+    Connect to the remote ssh server given in the configuration. If a connected
+    client is provided it is reused, and left open for the next case.
+
+    Args:
+        config (dict): Server configuration
+        client (SSHClient): Connected client to reuse
+
+    Yields:
+        client (SSHClient): Connected client
     """
+    if client is not None:
+        yield client
+        return
+
+    try:
+        hostname = config['hostname']
+        username = config['username']
+        password = config['password']
+    except KeyError:
+        raise ValueError('Invalid configuration file')
+
+    client = paramiko.SSHClient()
+    client.load_system_host_keys()
+    client.connect(hostname, username=username, password=password)
+
+    # Use a larger window for the channels opened for file transfer
+    client.get_transport().default_window_size = 2 ** 27
+
     try:
-        sftp.stat(path)
-    except IOError as e:
-        if e.errno == errno.ENOENT:
-            return False
-    else:
-        return True
+        yield client
+    finally:
+        client.close()
 
 
-def run_simulation(config_path, local_dir, case_name):
+def run_simulation(config_path, local_dir, case_name, client=None):
     """
     Run simulation of case on a remote ssh server with
     given input configuration.
@@ -29,58 +55,55 @@ def run_simulation(config_path, local_dir, case_name):
         config_path (str): Path to configuration file
         local_dir (str): Path to case folder
         case_name (str): Case name
+        client (SSHClient): Connected client to reuse across several cases, opens a new connection if None
     """
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-
-    config = json.load(open(config_path))
+    with open(config_path) as f:
+        config = json.load(f)
 
     try:
-        hostname = config['hostname']
-        username = config['username']
-        password = config['password']
         remote_folder = config['remoteFolder']
     except KeyError:
         raise ValueError('Invalid configuration file')
 
-    # Get path to home folder on remote
-    client.connect(hostname, username=username, password=password)
-    stdin, stdout, stderr = client.exec_command('echo $HOME')
-    home = str(stdout.read().strip())
-
-    sftp = client.open_sftp()
-    remote_folder = os.path.join(home, remote_folder)
+    with ssh_session(config, client) as client:
+        # Get path to home folder on remote
+        stdin, stdout, stderr = client.exec_command('echo $HOME')
+        home = str(stdout.read().strip())
 
-    # Uplad run script
-    sftp.chdir(os.path.join(remote_folder))
-    if not exists(sftp, case_name + ".sh"):
-        sftp.put(os.path.join(local_dir, case_name + ".sh"), case_name + ".sh")
+        sftp = client.open_sftp()
+        remote_folder = os.path.join(home, remote_folder)
 
-    # Upload mesh 
-    sftp.chdir(os.path.join(remote_folder, "mesh"))
-    if not exists(sftp, case_name + ".xml.gz"):
-        sftp.put(os.path.join(local_dir, case_name + ".xml.gz"), case_name + ".xml.gz")
+        # Files to upload: run script, mesh, probe points and info
+        files = [(case_name + ".sh", remote_folder),
+                 (case_name + ".xml.gz", os.path.join(remote_folder, "mesh")),
+                 (case_name + "_probe_point", os.path.join(remote_folder, "input")),
+                 (case_name + ".txt", os.path.join(remote_folder, "input"))]
 
-    # Upload probe points and info
-    sftp.chdir(os.path.join(remote_folder, "input"))
-    if not exists(sftp, case_name + "_probe_point"):
-        sftp.put(os.path.join(local_dir, case_name + "_probe_point"), case_name + "_probe_point")
-    if not exists(sftp, case_name + ".txt"):
-        sftp.put(os.path.join(local_dir, case_name + ".txt"), case_name + ".txt")
+        # List each remote folder once, instead of checking each file separately
+        remote_files = {remote_dir: set(sftp.listdir(remote_dir)) for remote_dir in set(d for _, d in files)}
+        uploads = [(os.path.join(local_dir, name), os.path.join(remote_dir, name)) for name, remote_dir in files
+                   if name not in remote_files[remote_dir]]
 
-    if not exists(sftp, os.path.join(remote_folder, "results", case_name)):
-        sftp.mkdir(os.path.join(remote_folder, "results", case_name))
+        if case_name not in sftp.listdir(os.path.join(remote_folder, "results")):
+            sftp.mkdir(os.path.join(remote_folder, "results", case_name))
 
-    sftp.close()
+        sftp.close()
 
-    # Run script
-    script_path = os.path.join(remote_folder, case_name + ".sh")
-    stdin, stdout, stderr = client.exec_command(os.path.join(remote_folder, 'run.sh {}'.format(script_path)))
+        # Upload files in parallel, each on its own SFTP channel
+        def upload(paths):
+            upload_sftp = client.open_sftp()
+            try:
+                upload_sftp.put(*paths)
+            finally:
+                upload_sftp.close()
 
-    for msg in stdout:
-        print(msg)
+        with ThreadPoolExecutor(max_workers=max(1, len(uploads))) as executor:
+            list(executor.map(upload, uploads))
 
-    for msg in stderr:
-        print(msg)
+        # Run script
+        script_path = os.path.join(remote_folder, case_name + ".sh")
+        stdin, stdout, stderr = client.exec_command(os.path.join(remote_folder, 'run.sh {}'.format(script_path)))
 
-    client.close()
+        # Read the output in bulk once the script has finished
+        sys.stdout.write(stdout.read().decode())
+        sys.stderr.write(stderr.read().decode())
@@ -1,5 +1,6 @@
 import json
 import pickle
+from concurrent.futures import ThreadPoolExecutor
 from os import path, makedirs
 from pprint import pprint
 
@@ -29,8 +30,12 @@ set_log_level(50)
 def problem_parameters(commandline_kwargs, NS_parameters, NS_expressions, **NS_namespace):
     if "restart_folder" in commandline_kwargs.keys():
         restart_folder = commandline_kwargs["restart_folder"]
-        f = open(path.join(restart_folder, 'params.dat'), 'rb')
-        NS_parameters.update(pickle.load(f))
+        # Read parameters on one processor, and broadcast to the rest
+        restart_parameters = None
+        if MPI.rank(MPI.comm_world) == 0:
+            with open(path.join(restart_folder, 'params.dat'), 'rb') as f:
+                restart_parameters = pickle.load(f)
+        NS_parameters.update(MPI.comm_world.bcast(restart_parameters, root=0))
         NS_parameters['restart_folder'] = restart_folder
     else:
         # Parameters are in mm and ms
@@ -87,10 +92,12 @@ def create_bcs(t, NS_expressions, V, Q, area_ratio, area_inlet, mesh, mesh_path,
     # Mesh function
     boundary = MeshFunction("size_t", mesh, mesh.geometry().dim() - 1, mesh.domains())
 
-    # Read case parameters
-    info = mesh_path.split(".xml")[0] + "_info.json"
-    with open(info) as f:
-        info = json.load(f)
+    # Read case parameters on one processor, and broadcast to the rest
+    info = None
+    if MPI.rank(MPI.comm_world) == 0:
+        with open(mesh_path.split(".xml")[0] + "_info.json") as f:
+            info = json.load(f)
+    info = MPI.comm_world.bcast(info, root=0)
 
     id_in[:] = info['inlet_id']
     id_out[:] = info['outlet_ids']
@@ -101,8 +108,11 @@ def create_bcs(t, NS_expressions, V, Q, area_ratio, area_inlet, mesh, mesh_path,
     area_ratio[:] = info['area_ratio']
     area_inlet.append(info['inlet_area'])
 
-    # Load normalized time and flow rate values
-    t_values, Q_ = np.loadtxt(path.join(path.dirname(path.abspath(__file__)), "ICA_values")).T
+    # Load normalized time and flow rate values on one processor, and broadcast to the rest
+    flow_values = None
+    if MPI.rank(MPI.comm_world) == 0:
+        flow_values = np.loadtxt(path.join(path.dirname(path.abspath(__file__)), "ICA_values"))
+    t_values, Q_ = MPI.comm_world.bcast(flow_values, root=0).T
     Q_values = Q_mean * Q_  # Specific flow rate = Normalized flow wave form * Prescribed flow rate
     t_values *= 1000  # Scale time in normalised flow wave form to [ms]
     tmp_area, tmp_center, tmp_radius, tmp_normal = compute_boundary_geometry_acrn(mesh, id_in[0], boundary)
@@ -116,17 +126,16 @@ def create_bcs(t, NS_expressions, V, Q, area_ratio, area_inlet, mesh, mesh_path,
     for uc in inlet:
         uc.set_t(t)
 
-    # Create pressure boundary condition
-    area_out = []
-    for i, ind in enumerate(id_out):
-        dsi = ds(ind, domain=mesh, subdomain_data=boundary)
-        area_out.append(assemble(Constant(1.0, name="one") * dsi))
+    # Create pressure boundary condition, with initial pressure given by the area fraction of each outlet
+    area_out = np.array([assemble(Constant(1.0, name="one") * ds(ind, domain=mesh, subdomain_data=boundary))
+                         for ind in id_out])
+    area_fraction = area_out / area_out.sum()
 
     bc_p = []
     if MPI.rank(MPI.comm_world) == 0:
         print("=== Initial pressure and area fraction ===")
     for i, ID in enumerate(id_out):
-        p_initial = area_out[i] / sum(area_out)
+        p_initial = float(area_fraction[i])
         outflow = Expression("p", p=p_initial, degree=pressure_degree)
         bc = DirichletBC(Q, outflow, boundary, ID)
         bc_p.append(bc)
@@ -150,23 +159,51 @@ def create_bcs(t, NS_expressions, V, Q, area_ratio, area_inlet, mesh, mesh_path,
 
 # Oasis hook called before simulation start
 def pre_solve_hook(mesh, V, Q, newfolder, mesh_path, restart_folder, velocity_degree, cardiac_cycle,
-                   save_solution_after_cycle, dt, **NS_namespace):
+                   save_solution_after_cycle, dt, u_, id_in, id_out, **NS_namespace):
+    # Processor rank, reused every time step
+    rank = MPI.rank(MPI.comm_world)
+
     # Mesh function
     boundary = MeshFunction("size_t", mesh, mesh.geometry().dim() - 1, mesh.domains())
 
-    # Create point for evaluation
+    # Compile the inlet and outlet fluxes once into one form, with one real test function component per boundary,
+    # so all fluxes are assembled into one vector and reused every time step.
+    # The flux integrand is a polynomial of the velocity degree, integrated exactly with the matching quadrature degree
     n = FacetNormal(mesh)
+    ds_flux = Measure("ds", domain=mesh, subdomain_data=boundary, metadata={"quadrature_degree": velocity_degree})
+    flux_ids = [id_in[0]] + list(id_out)
+    R = VectorFunctionSpace(mesh, "R", 0, dim=len(flux_ids))
+    q = TestFunction(R)
+    flux_form = Form(sum(dot(u_, n) * q[i] * ds_flux(flux_id) for i, flux_id in enumerate(flux_ids)))
+    flux_vector = assemble(flux_form)
+
+    # Reassemble the fluxes through one assembler, calling it directly to skip the Python assemble wrapper
+    flux_assembler = Assembler()
+
+    # Global dof of each flux, in the order of flux_ids
+    flux_dofs = [R.dofmap().local_to_global_index(R.sub(i).dofmap().cell_dofs(0)[0]) for i in range(len(flux_ids))]
+
+    # Create point for evaluation
     eval_dict = {}
     rel_path = mesh_path.split(".xml")[0] + "_probe_point"
-    probe_points = np.load(rel_path, encoding='latin1', fix_imports=True, allow_pickle=True)
+    probe_points = None
 
-    # Store points file in checkpoint
-    if MPI.rank(MPI.comm_world) == 0:
+    # Read probe points on one processor, store points file in checkpoint, and create folder for storing probes
+    probe_folder = path.join(newfolder, "Probes")
+    if rank == 0:
+        probe_points = np.load(rel_path, encoding='latin1', fix_imports=True, allow_pickle=True)
         probe_points.dump(path.join(newfolder, "Checkpoint", "points"))
+        makedirs(probe_folder, exist_ok=True)
+
+    probe_points = MPI.comm_world.bcast(probe_points, root=0)
 
+    # Write probes on a background thread, overlapping file I/O with the next time steps
+    probe_writer = ProbeWriter()
+
+    # Locate the probes once for the velocity space, and copy them for the remaining components
     eval_dict["centerline_u_x_probes"] = Probes(probe_points.flatten(), V)
-    eval_dict["centerline_u_y_probes"] = Probes(probe_points.flatten(), V)
-    eval_dict["centerline_u_z_probes"] = Probes(probe_points.flatten(), V)
+    eval_dict["centerline_u_y_probes"] = Probes(eval_dict["centerline_u_x_probes"])
+    eval_dict["centerline_u_z_probes"] = Probes(eval_dict["centerline_u_x_probes"])
     eval_dict["centerline_p_probes"] = Probes(probe_points.flatten(), Q)
 
     if restart_folder is None:
@@ -180,6 +217,11 @@ def pre_solve_hook(mesh, V, Q, newfolder, mesh_path, restart_folder, velocity_de
     with HDF5File(MPI.comm_world, files["mesh"], "w") as mesh_file:
         mesh_file.write(mesh, "mesh")
 
+    # Open files for storing velocity and pressure, kept open for the whole simulation
+    file_mode = "w" if not path.exists(files["p"]) else "a"
+    viz_p = HDF5File(MPI.comm_world, files["p"], file_mode=file_mode)
+    viz_u = HDF5File(MPI.comm_world, files["u"], file_mode=file_mode)
+
     # Create vector function for storing velocity
     Vv = VectorFunctionSpace(mesh, "CG", velocity_degree)
     U = Function(Vv)
@@ -191,25 +233,28 @@ def pre_solve_hook(mesh, V, Q, newfolder, mesh_path, restart_folder, velocity_de
     # Tstep when solutions for post processing should start being saved
     save_solution_at_tstep = int(cardiac_cycle * save_solution_after_cycle / dt)
 
-    return dict(eval_dict=eval_dict, boundary=boundary, n=n, U=U, u_mean=u_mean, u_mean0=u_mean0, u_mean1=u_mean1,
+    return dict(eval_dict=eval_dict, probe_folder=probe_folder, probe_writer=probe_writer, boundary=boundary, n=n,
+                flux_form=flux_form, flux_vector=flux_vector, flux_dofs=flux_dofs, flux_assembler=flux_assembler,
+                viz_p=viz_p, viz_u=viz_u, U=U, rank=rank, u_mean=u_mean, u_mean0=u_mean0, u_mean1=u_mean1,
                 u_mean2=u_mean2, save_solution_at_tstep=save_solution_at_tstep)
 
 
 # Oasis hook called after each time step
-def temporal_hook(u_, p_, mesh, tstep, dump_probe_frequency, eval_dict, newfolder, id_in, id_out, boundary, n,
-                  save_solution_frequency, NS_parameters, NS_expressions, area_ratio, t, save_solution_at_tstep,
-                  U, area_inlet, nu, u_mean0, u_mean1, u_mean2, **NS_namespace):
+def temporal_hook(u_, p_, tstep, dump_probe_frequency, eval_dict, probe_folder, probe_writer, id_out, flux_form,
+                  flux_vector, flux_dofs, flux_assembler, save_solution_frequency, NS_expressions, area_ratio, t,
+                  save_solution_at_tstep, viz_p, viz_u, U, rank, area_inlet, nu, u_mean0, u_mean1, u_mean2,
+                  **NS_namespace):
     # Update boundary condition to current time
     for uc in NS_expressions["inlet"]:
         uc.set_t(t)
 
     # Compute flux and update pressure condition
     if tstep > 2:
-        Q_ideals, Q_in, Q_outs = update_pressure_condition(NS_expressions, area_ratio, boundary, id_in, id_out, mesh, n,
-                                                           tstep, u_)
+        Q_ideals, Q_in, Q_outs = update_pressure_condition(NS_expressions, area_ratio, flux_form, flux_vector,
+                                                           flux_dofs, flux_assembler, id_out, tstep)
 
     # Compute flow rates and updated pressure at outlets, and mean velocity and Reynolds number at inlet
-    if MPI.rank(MPI.comm_world) == 0 and tstep % 10 == 0:
+    if rank == 0 and tstep % 10 == 0:
         U_mean = Q_in / area_inlet[0]
         diam_inlet = np.sqrt(4 * area_inlet[0] / np.pi)
         Re = U_mean * diam_inlet / nu
@@ -232,22 +277,15 @@ def temporal_hook(u_, p_, mesh, tstep, dump_probe_frequency, eval_dict, newfolde
     if tstep % dump_probe_frequency == 0:
         # Save variables along the centerline for CFD simulation
         # diagnostics and light-weight post processing
-        filepath = path.join(newfolder, "Probes")
-        if MPI.rank(MPI.comm_world) == 0:
-            if not path.exists(filepath):
-                makedirs(filepath)
-
         arr_u_x = eval_dict["centerline_u_x_probes"].array()
         arr_u_y = eval_dict["centerline_u_y_probes"].array()
         arr_u_z = eval_dict["centerline_u_z_probes"].array()
         arr_p = eval_dict["centerline_p_probes"].array()
 
-        # Dump stats
-        if MPI.rank(MPI.comm_world) == 0:
-            arr_u_x.dump(path.join(filepath, "u_x_%s.probes" % str(tstep)))
-            arr_u_y.dump(path.join(filepath, "u_y_%s.probes" % str(tstep)))
-            arr_u_z.dump(path.join(filepath, "u_z_%s.probes" % str(tstep)))
-            arr_p.dump(path.join(filepath, "p_%s.probes" % str(tstep)))
+        # Dump stats to a single file
+        if rank == 0:
+            probe_writer.write(path.join(probe_folder, "probes_{}.npz".format(tstep)),
+                               u_x=arr_u_x, u_y=arr_u_y, u_z=arr_u_z, p=arr_p)
 
         # Clear stats
         MPI.barrier(MPI.comm_world)
@@ -263,21 +301,13 @@ def temporal_hook(u_, p_, mesh, tstep, dump_probe_frequency, eval_dict, newfolde
         assign(U.sub(1), u_[1])
         assign(U.sub(2), u_[2])
 
-        # Get save paths
-        files = NS_parameters['files']
-        p_path = files['p']
-        u_path = files['u']
-        file_mode = "w" if not path.exists(p_path) else "a"
-
         # Save pressure
-        viz_p = HDF5File(MPI.comm_world, p_path, file_mode=file_mode)
         viz_p.write(p_, "/pressure", tstep)
-        viz_p.close()
+        viz_p.flush()
 
         # Save velocity
-        viz_u = HDF5File(MPI.comm_world, u_path, file_mode=file_mode)
         viz_u.write(U, "/velocity", tstep)
-        viz_u.close()
+        viz_u.flush()
 
         # Accumulate velocity
         u_mean0.vector().axpy(1, u_[0].vector())
@@ -286,8 +316,13 @@ def temporal_hook(u_, p_, mesh, tstep, dump_probe_frequency, eval_dict, newfolde
 
 
 # Oasis hook called after the simulation has finished
-def theend_hook(u_mean, u_mean0, u_mean1, u_mean2, T, dt, save_solution_at_tstep, save_solution_frequency,
-                **NS_namespace):
+def theend_hook(u_mean, u_mean0, u_mean1, u_mean2, T, dt, save_solution_at_tstep, save_solution_frequency, viz_p,
+                viz_u, probe_writer, **NS_namespace):
+    # Close velocity and pressure files, and wait for remaining probes to be written
+    viz_p.close()
+    viz_u.close()
+    probe_writer.close()
+
     # get the file path
     files = NS_parameters['files']
     u_mean_path = files["u_mean"]
@@ -307,72 +342,85 @@ def theend_hook(u_mean, u_mean0, u_mean1, u_mean2, T, dt, save_solution_at_tstep
         u_mean_file.write(u_mean, "u_mean")
 
 
+class ProbeWriter(object):
+    """Writes probe dumps on a background thread, one at a time.
+
+    An error from a write is raised by the next call to write or close.
+    """
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._future = None
+
+    def _wait(self):
+        if self._future is not None:
+            self._future.result()
+            self._future = None
+
+    def write(self, file_path, **arrays):
+        self._wait()
+        self._future = self._executor.submit(np.savez_compressed, file_path, **arrays)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._wait()
+
+
 def beta(err, p):
     """
     Adjusted choice of beta for the dual-pressure boundary condition.
-    Ramped up to desired value if flow rate error (err) increases
+    Ramped up to desired value if flow rate error (err) increases.
+    Evaluated element-wise, so all outlets can be updated at once.
 
     Args:
-        err (float): Flow split error
-        p (float): Pressure value
+        err (float, ndarray): Flow split error
+        p (float, ndarray): Pressure value
 
     Returns:
-        beta (float): Variable factor in flow split method
+        beta (float, ndarray): Variable factor in flow split method
     """
-    if p < 0:
-        if err >= 0.1:
-            return 0.5
-        else:
-            return 1 - 5 * err ** 2
-    else:
-        if err >= 0.1:
-            return 1.5
-        else:
-            return 1 + 5 * err ** 2
+    sign = np.where(p < 0, -1.0, 1.0)
+    return np.where(err >= 0.1, 1 + 0.5 * sign, 1 + sign * 5 * err ** 2)
 
 
-def update_pressure_condition(NS_expressions, area_ratio, boundary, id_in, id_out, mesh, n, tstep, u_):
+def update_pressure_condition(NS_expressions, area_ratio, flux_form, flux_vector, flux_dofs, flux_assembler, id_out,
+                              tstep):
     """
     Use a dual-pressure boundary condition as pressure condition at outlet.
     """
-    Q_in = abs(assemble(dot(u_, n) * ds(id_in[0], domain=mesh, subdomain_data=boundary)))
-    Q_outs = []
-    Q_ideals = []
-    for i, out_id in enumerate(id_out):
-        Q_out = abs(assemble(dot(u_, n) * ds(out_id, domain=mesh, subdomain_data=boundary)))
-        Q_outs.append(Q_out)
-
-        Q_ideal = area_ratio[i] * Q_in
-        Q_ideals.append(Q_ideal)
-
-        p_old = NS_expressions[out_id].p
-
-        R_optimal = area_ratio[i]
-        R_actual = Q_out / Q_in
-
-        M_err = abs(R_optimal / R_actual)
-        R_err = abs(R_optimal - R_actual)
-
-        if p_old < 0:
-            E = 1 + R_err / R_optimal
-        else:
-            E = -1 * (1 + R_err / R_optimal)
-
-        # 1) Linear update to converge first 100 tsteps of first cycle
-        delta = (R_optimal - R_actual) / R_optimal
-        if tstep < 100:
-            h = 0.1
-            if p_old > 1 and delta < 0:
-                NS_expressions[out_id].p = p_old
-            else:
-                NS_expressions[out_id].p = p_old * (1 - delta * h)
-
-        # 2) Dual pressure BC
-        else:
-            if p_old > 2 and delta < 0:
-                NS_expressions[out_id].p = p_old
-            else:
-                NS_expressions[out_id].p = p_old * beta(R_err, p_old) * M_err ** E
+    # Assemble the inlet and outlet fluxes into one vector, and share its values with all processors
+    flux_assembler.assemble(flux_vector, flux_form)
+    Q = np.abs(MPI.comm_world.bcast(flux_vector.gather_on_zero(), root=0)[flux_dofs])
+    Q_in = Q[0]
+    Q_outs = Q[1:]
+
+    # Compute flow split errors for all outlets at once
+    R_optimal = np.asarray(area_ratio)
+    R_actual = Q_outs / Q_in
+    Q_ideals = R_optimal * Q_in
+
+    M_err = np.abs(R_optimal / R_actual)
+    R_err = np.abs(R_optimal - R_actual)
+    delta = (R_optimal - R_actual) / R_optimal
+
+    # Keep the pressure at outlets where it is already high and the flow rate is too large, and update the rest
+    p_old = np.array([NS_expressions[out_id].p for out_id in id_out])
+    p_max = 1 if tstep < 100 else 2
+    update = ~((p_old > p_max) & (delta < 0))
+    p_new = p_old.copy()
+
+    # 1) Linear update to converge first 100 tsteps of first cycle
+    if tstep < 100:
+        h = 0.1
+        p_new[update] = p_old[update] * (1 - delta[update] * h)
+
+    # 2) Dual pressure BC
+    else:
+        p, R_err, M_err, R_optimal = p_old[update], R_err[update], M_err[update], R_optimal[update]
+        E = np.where(p < 0, 1, -1) * (1 + R_err / R_optimal)
+        p_new[update] = p * beta(R_err, p) * M_err ** E
+
+    for out_id, p in zip(id_out, p_new):
+        NS_expressions[out_id].p = float(p)
 
     return Q_ideals, Q_in, Q_outs
 
@@ -423,8 +471,7 @@ def get_file_paths(folder):
     # Create folder where data and solutions (velocity, mesh, pressure) is stored
     common_path = path.join(folder, "Solutions")
     if MPI.rank(MPI.comm_world) == 0:
-        if not path.exists(common_path):
-            makedirs(common_path)
+        makedirs(common_path, exist_ok=True)
 
     file_p = path.join(common_path, "p.h5")
     file_u = path.join(common_path, "u.h5")
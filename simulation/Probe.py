@@ -7,7 +7,7 @@ This module contains functionality for efficiently probing a Function many times
 """
 import cppimport
 from mpi4py.MPI import COMM_WORLD as comm
-from numpy import zeros, squeeze, save
+from numpy import zeros, empty, squeeze, save
 
 probe11 = cppimport.imp('probe.probe11')
 
@@ -43,10 +43,12 @@ class Probes(probe11.Probes):
         is_root = comm.Get_rank() == root
         size = self.get_total_number_probes() if is_root else len(self)
         comp = self.value_size() if component is None else 1
+        # Local arrays are fully overwritten, only root needs zeros for probes not found on any processor
+        alloc = zeros if is_root else empty
         if not N is None:
-            z = zeros((size, comp))
+            z = alloc((size, comp))
         else:
-            z = zeros((size, comp, self.number_of_evaluations()))
+            z = alloc((size, comp, self.number_of_evaluations()))
 
         # Get all values
         if len(self) > 0:
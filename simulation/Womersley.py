@@ -125,6 +125,31 @@ def fourier_coefficients(x, y, T, N):
     return ck
 
 
+class WomersleyProfile(object):
+    """Coefficients and values of the Womersley profile, shared by all the components of the profile."""
+    def __init__(self):
+        self.r_dependent_coeffs = {}
+        self.values = {}
+        self.t = None
+        self._stacked_r = []
+        self._stacked_coeffs = None
+
+    def evaluate(self, t, expnt):
+        "Evaluate the profile at all cached coordinates with a single matrix-vector product, once for each time."
+        if len(self._stacked_r) != len(self.r_dependent_coeffs):
+            self._stacked_r = list(self.r_dependent_coeffs.keys())
+            self._stacked_coeffs = np.array(list(self.r_dependent_coeffs.values()))
+        elif t == self.t:
+            return
+
+        self.t = t
+        if self._stacked_coeffs is None:
+            self.values = {}
+        else:
+            wom = (self._stacked_coeffs[:, 0] + self._stacked_coeffs[:, 1:].dot(expnt)).real
+            self.values = dict(zip(self._stacked_r, wom))
+
+
 class WomersleyComponent(UserExpression):
     # Subclassing the expression class restricts the number of arguments, args
     # is therefore a dict of arguments.
@@ -157,7 +182,7 @@ class WomersleyComponent(UserExpression):
 
         # Precomputation
         self._precompute_bessel_functions()
-        self._all_r_dependent_coeffs = {}
+        self._profile = WomersleyProfile()
 
         super().__init__(element=element)
 
@@ -203,24 +228,26 @@ class WomersleyComponent(UserExpression):
     def _get_r_dependent_coeffs(self, y):
         "Look for cached womersley coeffs."
         key = y
-        r_dependent_coeffs = self._all_r_dependent_coeffs.get(key)
+        r_dependent_coeffs = self._profile.r_dependent_coeffs.get(key)
         if r_dependent_coeffs is None:
             # Cache miss! Compute coeffs for this coordinate the first time.
             r_dependent_coeffs = self._precompute_r_dependent_coeffs(y)
-            self._all_r_dependent_coeffs[key] = r_dependent_coeffs
+            self._profile.r_dependent_coeffs[key] = r_dependent_coeffs
         return r_dependent_coeffs
 
     def set_t(self, t):
         self.t = float(t) % self.period
         self._expnt = np.exp((self.omega * self.t * 1j) * self.ns)
+        self._profile.evaluate(self.t, self._expnt)
 
     def eval(self, value, x):
-        # Compute or get cached complex coefficients that only depend on r
+        # Look up the profile evaluated in set_t, or compute it from the cached coefficients that only depend on r
         y = np.sqrt(x_to_r2(x, self.center, self.normal)) / self.radius
-        coeffs = self._get_r_dependent_coeffs(y)
-
-        # Multiply complex coefficients for x with complex exponential functions in time
-        wom = (coeffs[0] + np.dot(coeffs[1:], self._expnt)).real
+        wom = self._profile.values.get(y)
+        if wom is None:
+            # Multiply complex coefficients for x with complex exponential functions in time
+            coeffs = self._get_r_dependent_coeffs(y)
+            wom = (coeffs[0] + np.dot(coeffs[1:], self._expnt)).real
 
         # Scale by negative normal direction and scale_value
         value[0] = -self.normal_component * self.scale_value * wom
@@ -251,4 +278,8 @@ def make_womersley_bcs(t, Q, mesh, nu, area, center, radius, normal,
         expressions.append(WomersleyComponent(radius, center, normal, ncomp, period, nu,
                                               element, Q=Q, V=V))
 
+    # The components only differ by the normal component, so share the cached coefficients and profile values
+    for expression in expressions[1:]:
+        expression._profile = expressions[0]._profile
+
     return expressions
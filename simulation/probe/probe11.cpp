@@ -56,6 +56,7 @@ PYBIND11_MODULE(probe11, m)
             const Array<double> _x(x.size(), const_cast<double*>(x.data()));
             return Probes(_x, _v);
         }))
+        .def(py::init<const Probes&>())
         .def("eval", [](Probes& self, py::object v){
             auto _v = v.attr("_cpp_object").cast<const Function&>();
             self.eval(_v);